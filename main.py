@@ -1,48 +1,119 @@
+import asyncio
+import math
 import os
 from datetime import date
 
+import aiohttp
+import numpy as np
+import orjson
 import pandas as pd
-import requests
+from postgrest.types import ReturnMethod
 from supabase import create_client
 
+RETRY_TOTAL = 3
+RETRY_BACKOFF_FACTOR = 0.3
+RETRY_STATUSES = {429, 502, 503, 504}
 
-def fetch_properties_from_municipality(municipality: str, per_page: int = 1000):
+# ingen total-timeout: den tæller også ventetid på en ledig forbindelse i
+# connector-poolen, og alle sider for en kommune sættes i gang på én gang
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=30)
+
+
+async def _fetch_page(
+    session: aiohttp.ClientSession, municipality: str, page: int, per_page: int
+) -> dict:
     url = "https://api.boligsiden.dk/search/cases"
-    params = {"municipalities": municipality, "per_page": per_page}
+    params = {"municipalities": municipality, "page": page, "per_page": per_page}
+    for attempt in range(RETRY_TOTAL + 1):
+        # samme backoff som urllib3's Retry: factor * 2^(forsøg)
+        delay = RETRY_BACKOFF_FACTOR * 2**attempt
+        try:
+            async with session.get(url, params=params, timeout=REQUEST_TIMEOUT) as response:
+                if response.status in RETRY_STATUSES and attempt < RETRY_TOTAL:
+                    # ligesom urllib3 respekteres Retry-After ved 429
+                    retry_after = response.headers.get("Retry-After", "")
+                    if response.status == 429 and retry_after.isdigit():
+                        delay = int(retry_after)
+                else:
+                    response.raise_for_status()
+                    return orjson.loads(await response.read())
+        except aiohttp.ClientResponseError:
+            # statuskoder uden for RETRY_STATUSES prøves ikke igen
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            # afbrudte keep-alive-forbindelser og timeouts prøves igen som urllib3
+            if attempt == RETRY_TOTAL:
+                raise
+        await asyncio.sleep(delay)
+
+
+async def fetch_properties_from_municipality(
+    session: aiohttp.ClientSession, municipality: str, per_page: int = 500
+):
     try:
-        response = requests.get(url, params=params, timeout=30)
-        response.raise_for_status()
-        return response.json().get("cases", [])
+        first = await _fetch_page(session, municipality, 1, per_page)
+        cases = first.get("cases", [])
+        total = first.get("totalHits")
+
+        # api'et kan give færre rækker pr. side end per_page, så sidestørrelsen
+        # tages fra det der faktisk kom tilbage på første side
+        page_size = len(cases)
+
+        if isinstance(total, int):
+            # kender vi totalen, hentes de resterende sider samtidigt
+            n_pages = math.ceil(total / page_size) if page_size else 1
+            pages = await asyncio.gather(
+                *(_fetch_page(session, municipality, p, per_page) for p in range(2, n_pages + 1))
+            )
+            for page in pages:
+                cases.extend(page.get("cases", []))
+
+            if len(cases) != total:
+                print(f"⚠️ {municipality}: hentede {len(cases)} af {total} boliger")
+        else:
+            # ellers bladres der videre, til en side kommer tilbage ufuld eller tom
+            page_no, page_cases = 1, cases
+            while page_cases and len(page_cases) == page_size:
+                page_no += 1
+                page_cases = (await _fetch_page(session, municipality, page_no, per_page)).get("cases", [])
+                cases.extend(page_cases)
+
+        return cases
     except Exception as e:
         print(f"❌ fejl ved {municipality}: {e}")
         return []
 
 
-def flatten_entry(entry, update_date=None):
-    if update_date is None:
-        update_date = str(date.today())
-
-    address = entry.get("address", {}) or {}
-    time_on_market = entry.get("timeOnMarket", {}) or {}
-
-    return {
-        "kommune": address.get("municipality", {}).get("name")
-        if isinstance(address.get("municipality"), dict)
-        else None,
-        "salgspris_kr": entry.get("priceCash"),
-        "pris_per_m2_kr": entry.get("perAreaPrice"),
-        "dage_paa_marked_nu": time_on_market.get("current", {}).get("days")
-        if isinstance(time_on_market.get("current"), dict)
-        else None,
-        "boligareal_m2": address.get("livingArea"),
-        "opdateringsdato": update_date,
-        "adresse": address.get("roadName"),
-        "husnummer": address.get("houseNumber"),
-        "postnummer": address.get("zipCode"),
-        "by": address.get("city", {}).get("name")
-        if isinstance(address.get("city"), dict)
-        else None,
-    }
+KEEP_COLS = [
+    "kommune",
+    "salgspris_kr",
+    "pris_per_m2_kr",
+    "dage_paa_marked_nu",
+    "boligareal_m2",
+    "opdateringsdato",
+    "adresse",
+    "husnummer",
+    "postnummer",
+    "by",
+]
+
+# priserne beholdes som float64: summen af udbuddet løber op i milliarder,
+# og float32 kan kun repræsentere hele kroner op til ca. 16,7 mio.
+# dage og m² er små tal, som float32 rammer præcist, så de kan nedskaleres.
+NUMERIC_DTYPES = {
+    "salgspris_kr": np.float64,
+    "pris_per_m2_kr": np.float64,
+    "dage_paa_marked_nu": np.float32,
+    "boligareal_m2": np.float32,
+}
+
+
+def _sub(d: dict, key: str, inner: str):
+    """
+    Slår d[key][inner] op, og giver None hvis d[key] mangler eller ikke er en dict.
+    """
+    v = d.get(key)
+    return v.get(inner) if isinstance(v, dict) else None
 
 
 def scrape_sydjylland_boliger():
@@ -59,80 +130,107 @@ def scrape_sydjylland_boliger():
         "Middelfart",
     ]
 
+    async def _run():
+        # én connector til alle kald, så keep-alive genbruger forbindelsen til api'et
+        connector = aiohttp.TCPConnector(limit=10)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            return await asyncio.gather(
+                *(fetch_properties_from_municipality(session, mun) for mun in municipalities)
+            )
+
     all_properties = []
     print(f"🚀 henter boliger fra {len(municipalities)} kommuner...")
 
-    for mun in municipalities:
-        props = fetch_properties_from_municipality(mun)
+    results = asyncio.run(_run())
+    for mun, props in zip(municipalities, results):
         all_properties.extend(props)
         print(f"✅ {mun}: {len(props)} boliger")
 
     print(f"✅ total hentet: {len(all_properties)} boliger")
 
-    flat_data = [flatten_entry(p) for p in all_properties]
-    df = pd.DataFrame(flat_data)
-
-    numeric_cols = ["salgspris_kr", "pris_per_m2_kr", "dage_paa_marked_nu", "boligareal_m2"]
-    for col in numeric_cols:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors="coerce")
+    # én liste pr. kolonne, så pandas kan bygge frame'en kolonnevis uden transpose
+    cols = {k: [] for k in KEEP_COLS}
+    for p in all_properties:
+        address = p.get("address") or {}
+        time_on_market = p.get("timeOnMarket") or {}
+
+        cols["kommune"].append(_sub(address, "municipality", "name"))
+        cols["salgspris_kr"].append(p.get("priceCash"))
+        cols["pris_per_m2_kr"].append(p.get("perAreaPrice"))
+        cols["dage_paa_marked_nu"].append(_sub(time_on_market, "current", "days"))
+        cols["boligareal_m2"].append(address.get("livingArea"))
+        cols["adresse"].append(address.get("roadName"))
+        cols["husnummer"].append(address.get("houseNumber"))
+        cols["postnummer"].append(address.get("zipCode"))
+        cols["by"].append(_sub(address, "city", "name"))
+    cols["opdateringsdato"] = [str(date.today())] * len(all_properties)
+
+    # numeriske kolonner castes direkte ved opbygning (None -> NaN), så vi
+    # slipper for en ekstra pd.to_numeric-runde pr. kolonne bagefter
+    for col, dtype in NUMERIC_DTYPES.items():
+        try:
+            cols[col] = np.array(cols[col], dtype=dtype)
+        except (TypeError, ValueError):
+            # en enkelt ikke-numerisk værdi må ikke vælte kørslen -> NaN
+            cols[col] = pd.to_numeric(pd.Series(cols[col]), errors="coerce").astype(dtype).to_numpy()
+
+    df = pd.DataFrame(cols, copy=False)
 
     return df
 
 
-def calculate_daily_stats(df: pd.DataFrame) -> pd.DataFrame:
+def _round1(value) -> float | None:
+    """
+    Runder et gennemsnit/sum til 1 decimal, og sikrer at NaN -> None.
+    """
+    # pandas kan give NaN (float), som Supabase ikke kan lide
+    value = float(value)
+    return None if math.isnan(value) else round(value, 1)
+
+
+def calculate_daily_stats(df: pd.DataFrame) -> dict:
     print("📊 beregner daglig statistik...")
     today = date.today()
 
+    # alle totaler i ét agg-kald i stedet for en separat scanning pr. tal
+    summary = df[["salgspris_kr", "pris_per_m2_kr", "dage_paa_marked_nu"]].agg(
+        {
+            "salgspris_kr": ["mean", "median", "sum"],
+            "pris_per_m2_kr": "mean",
+            "dage_paa_marked_nu": "mean",
+        }
+    )
+    median_pris = summary.at["median", "salgspris_kr"]
+
     stats = {
         "Dato": str(today),  # matcher din tabel: text
         "Total_Antal_Boliger": int(len(df)),
-        "Total_Gns_Pris_kr": float(df["salgspris_kr"].mean()) if "salgspris_kr" in df.columns else None,
-        "Total_Median_Pris_kr": int(round(df["salgspris_kr"].median()))
-            if "salgspris_kr" in df.columns and pd.notna(df["salgspris_kr"].median())
-            else None,
-        "Total_Gns_M2_Pris_kr": float(df["pris_per_m2_kr"].mean()) if "pris_per_m2_kr" in df.columns else None,
-        "Total_Gns_Liggetid_dage": float(df["dage_paa_marked_nu"].mean()) if "dage_paa_marked_nu" in df.columns else None,
-        "Total_Samlet_Udbud_mia_kr": float(df["salgspris_kr"].sum() / 1_000_000_000)
-        if "salgspris_kr" in df.columns
-        else None,
+        "Total_Gns_Pris_kr": _round1(summary.at["mean", "salgspris_kr"]),
+        "Total_Median_Pris_kr": int(round(median_pris)) if pd.notna(median_pris) else None,
+        "Total_Gns_M2_Pris_kr": _round1(summary.at["mean", "pris_per_m2_kr"]),
+        "Total_Gns_Liggetid_dage": _round1(summary.at["mean", "dage_paa_marked_nu"]),
+        "Total_Samlet_Udbud_mia_kr": _round1(summary.at["sum", "salgspris_kr"] / 1_000_000_000),
     }
 
-    if "kommune" in df.columns:
-        kommuner = df["kommune"].dropna().unique()
-        for kommune in sorted(kommuner):
-            k_df = df[df["kommune"] == kommune]
-            prefix = str(kommune).replace(" ", "_")  # fx "Billund"
-
-            stats[f"{prefix}_Antal"] = int(len(k_df))
-            stats[f"{prefix}_Gns_Pris"] = float(k_df["salgspris_kr"].mean()) if "salgspris_kr" in k_df.columns else None
-            stats[f"{prefix}_Gns_M2_Pris"] = float(k_df["pris_per_m2_kr"].mean()) if "pris_per_m2_kr" in k_df.columns else None
-            stats[f"{prefix}_Gns_Liggetid"] = float(k_df["dage_paa_marked_nu"].mean()) if "dage_paa_marked_nu" in k_df.columns else None
-
-    stats_df = pd.DataFrame([stats])
-
-    # Runde kun numeriske kolonner
-    num_cols = stats_df.select_dtypes(include=["float64", "int64"]).columns
-    stats_df[num_cols] = stats_df[num_cols].round(1)
-
-    return stats_df
-
-
-def _row_to_payload(stats_df: pd.DataFrame) -> dict:
-    """
-    Konverterer 1 række stats_df til dict, og sikrer at NaN -> None.
-    """
-    row = stats_df.iloc[0].to_dict()
+    # én groupby-pass i stedet for en boolsk maske pr. kommune
+    g = df.groupby("kommune", sort=True, observed=True).agg(
+        antal=("salgspris_kr", "size"),
+        gns_pris=("salgspris_kr", "mean"),
+        gns_m2_pris=("pris_per_m2_kr", "mean"),
+        gns_liggetid=("dage_paa_marked_nu", "mean"),
+    )
+    for kommune, row in g.iterrows():
+        prefix = str(kommune).replace(" ", "_")  # fx "Billund"
 
-    # pandas kan have NaN (float), som Supabase ikke kan lide
-    for k, v in list(row.items()):
-        if pd.isna(v):
-            row[k] = None
+        stats[f"{prefix}_Antal"] = int(row.antal)
+        stats[f"{prefix}_Gns_Pris"] = _round1(row.gns_pris)
+        stats[f"{prefix}_Gns_M2_Pris"] = _round1(row.gns_m2_pris)
+        stats[f"{prefix}_Gns_Liggetid"] = _round1(row.gns_liggetid)
 
-    return row
+    return stats
 
 
-def upsert_daily_stats_to_supabase(stats_df: pd.DataFrame):
+def upsert_daily_stats_to_supabase(payload: dict):
     supabase_url = os.environ.get("SUPABASE_URL")
     supabase_key = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
 
@@ -143,13 +241,12 @@ def upsert_daily_stats_to_supabase(stats_df: pd.DataFrame):
 
     client = create_client(supabase_url, supabase_key)
 
-    payload = _row_to_payload(stats_df)
-
     # Upsert på 'Dato' kræver at du har unique constraint/index på kolonnen Dato.
     # Hvis du IKKE har unique på Dato endnu, så opret den i Supabase (Indexes -> Unique).
+    # returning=minimal: vi bruger ikke rækken, så postgrest skal ikke sende den retur.
     res = (
         client.table("daily_stats")
-        .upsert(payload, on_conflict="Dato")
+        .upsert(payload, on_conflict="Dato", returning=ReturnMethod.minimal)
         .execute()
     )
 
@@ -161,8 +258,8 @@ def upsert_daily_stats_to_supabase(stats_df: pd.DataFrame):
 
 def main():
     df = scrape_sydjylland_boliger()
-    stats_df = calculate_daily_stats(df)
-    upsert_daily_stats_to_supabase(stats_df)
+    stats = calculate_daily_stats(df)
+    upsert_daily_stats_to_supabase(stats)
 
 
 if __name__ == "__main__":